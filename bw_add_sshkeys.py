@@ -3,15 +3,92 @@
 Extracts SSH keys from Bitwarden vault
 """
 
-import argparse
+import os
+import sys
+
+# This script doubles as the SSH_ASKPASS program that hands passphrases to
+# ssh-add. All it has to do then is print the passphrase, so do that before
+# importing anything else.
+ASKPASS = os.path.realpath(__file__)
+
+if __name__ == "__main__" and os.environ.get("SSH_ASKPASS") == ASKPASS:
+    print(os.environ.get("SSH_KEY_PASSPHRASE"))
+    sys.exit()
+
+import atexit
 import json
 import logging
-import os
+import shutil
+import signal
+import socket
 import subprocess
-from typing import Any
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator
+
+# Modules only needed by some runs (argparse, keyring, http.client and
+# urllib) are imported where they are used, so other runs don't load them
+if TYPE_CHECKING:
+    import argparse
+
+try:
+    import ijson
+
+    HAVE_IJSON = True
+except ImportError:
+    HAVE_IJSON = False
+
+# orjson parses the (bytes) output of `bw` several times faster than json
+try:
+    import orjson
+
+    json_loads: Callable[[bytes], Any] = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
+# Log messages are only formatted if they are emitted, so pass their values
+# as %-style arguments rather than formatting them beforehand (with % or
+# f-strings), and guard any costly debug-only work with
+# logging.getLogger().isEnabledFor(logging.DEBUG)
 
-def get_session(session: str) -> str:
+# Python only starts commands with posix_spawn(), which is cheaper than
+# fork() + exec(), when close_fds is off. This is safe, as the file
+# descriptors Python opens are not inherited anyway (PEP 446).
+CLOSE_FDS = False
+
+# Absolute paths of the commands, looked up in $PATH once, so they don't have
+# to be searched for on every call (and posix_spawn() can be used)
+BW = shutil.which("bw") or "bw"
+SSH_ADD = shutil.which("ssh-add") or "ssh-add"
+
+# Environments for adding keys without and with a passphrase, shared by all
+# of them
+SSH_ADD_ENV = dict(os.environ, SSH_ASKPASS_REQUIRE="never")
+SSH_ADD_ASKPASS_ENV = dict(os.environ, SSH_ASKPASS=ASKPASS)
+
+# Service name the Bitwarden session is stored under with --keyring
+KEYRING_SERVICE = "bw_add_sshkeys"
+
+# Address of the `bw serve` instance started by start_server(), if any
+BW_SERVER = ""
+
+# Connection of each thread to `bw serve`, kept open between requests
+SERVER_CONNECTIONS = threading.local()
+
+
+def bw_command(*args: str, session: str = "") -> list[str]:
+    """
+    Function to return the command line to run the Bitwarden CLI with
+    """
+    command = [BW, *args]
+    if session:
+        command += ["--session", session]
+
+    return command
+
+
+def get_session(session: str, use_keyring: bool = False) -> str:
     """
     Function to return a valid Bitwarden session
     """
@@ -22,8 +99,16 @@ def get_session(session: str) -> str:
         logging.debug("Existing Bitwarden session found")
         return session
 
+    if use_keyring:
+        session = get_keyring_session()
+        if session:
+            logging.debug("Bitwarden session found in keyring")
+            return session
+
     # Check if we're already logged in
-    proc_logged = subprocess.run(["bw", "login", "--check", "--quiet"], check=False)
+    proc_logged = subprocess.run(
+        bw_command("login", "--check", "--quiet"), check=False, close_fds=CLOSE_FDS
+    )
 
     if proc_logged.returncode:
         logging.debug("Not logged into Bitwarden")
@@ -33,34 +118,183 @@ def get_session(session: str) -> str:
         operation = "unlock"
 
     proc_session = subprocess.run(
-        ["bw", "--raw", operation],
+        bw_command("--raw", operation),
         stdout=subprocess.PIPE,
         universal_newlines=True,
         check=True,
+        close_fds=CLOSE_FDS,
     )
     session = proc_session.stdout
     logging.info(
         'To re-use this BitWarden session run: export BW_SESSION="%s"',
         session,
     )
+
+    if use_keyring:
+        import keyring
+
+        try:
+            keyring.set_password(KEYRING_SERVICE, "session", session)
+        except keyring.errors.KeyringError as error:
+            logging.warning("Could not store Bitwarden session in keyring: %s", error)
+
     return session
 
 
-def get_folders(session: str, foldername: str) -> str:
+def get_keyring_session() -> str:
     """
-    Function to return the ID  of the folder that matches the provided name
+    Function to return the Bitwarden session stored in the keyring, if the
+    vault is still unlocked with it
     """
-    logging.debug("Folder name: %s", foldername)
+    try:
+        import keyring
+    except ImportError:
+        raise RuntimeError('The "keyring" package is required to use --keyring')
+
+    try:
+        session: str | None = keyring.get_password(KEYRING_SERVICE, "session")
+    except keyring.errors.KeyringError as error:
+        logging.warning("Could not read Bitwarden session from keyring: %s", error)
+        return ""
 
-    proc_folders = subprocess.run(
-        ["bw", "list", "folders", "--search", foldername, "--session", session],
+    if not session:
+        return ""
+
+    proc_status = subprocess.run(
+        bw_command("status", session=session),
         stdout=subprocess.PIPE,
-        universal_newlines=True,
-        check=True,
-        encoding="utf-8",
+        check=False,
+        close_fds=CLOSE_FDS,
     )
+    if proc_status.returncode:
+        logging.debug("Bitwarden session in keyring is no longer valid")
+        return ""
 
-    folders = json.loads(proc_folders.stdout)
+    try:
+        status = json_loads(proc_status.stdout)["status"]
+    except (ValueError, KeyError, TypeError) as error:
+        logging.debug("Could not read bw status output: %s", error)
+        return ""
+
+    if status != "unlocked":
+        logging.debug("Bitwarden session in keyring is no longer valid")
+        return ""
+
+    return session
+
+
+def start_server(session: str, timeout: float = 30) -> None:
+    """
+    Function to start a `bw serve` instance to answer all vault requests
+
+    This saves starting a new Bitwarden CLI process for every request.
+    """
+    global BW_SERVER
+
+    # Ask the OS for a free port
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+
+    logging.debug("Starting bw serve on port %d", port)
+
+    proc_server = subprocess.Popen(
+        bw_command("serve", "--port", str(port), session=session),
+        stdout=subprocess.DEVNULL,
+        close_fds=CLOSE_FDS,
+    )
+    atexit.register(proc_server.terminate)
+
+    # atexit handlers don't run when the script is killed by a signal, which
+    # would leave the server (and with it, the unlocked vault) running
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+
+    BW_SERVER = "localhost:%d" % port
+    deadline = time.monotonic() + timeout
+    while True:
+        if proc_server.poll() is not None:
+            BW_SERVER = ""
+            raise RuntimeError("bw serve exited with code %d" % proc_server.returncode)
+        try:
+            server_request("/status")
+            break
+        except RuntimeError:
+            if time.monotonic() > deadline:
+                BW_SERVER = ""
+                raise RuntimeError("bw serve did not start in %d seconds" % timeout)
+            time.sleep(0.1)
+
+    logging.debug("bw serve is ready")
+
+
+def server_request(path: str, **query: str) -> bytes:
+    """
+    Function to return the response body of a `bw serve` request
+    """
+    import http.client
+    import urllib.parse
+
+    connection: http.client.HTTPConnection | None = getattr(
+        SERVER_CONNECTIONS, "connection", None
+    )
+    if connection is None:
+        connection = http.client.HTTPConnection(BW_SERVER)
+        SERVER_CONNECTIONS.connection = connection
+
+    url = path
+    if query:
+        url += "?" + urllib.parse.urlencode(query)
+
+    # The server may have closed a connection that was idle for a while,
+    # in which case the request is sent again on a new connection
+    for retry in (True, False):
+        try:
+            connection.request("GET", url)
+            response = connection.getresponse()
+            body = response.read()
+            break
+        except (OSError, http.client.HTTPException) as error:
+            connection.close()
+            if not retry or not isinstance(
+                error, (ConnectionError, http.client.RemoteDisconnected)
+            ):
+                raise RuntimeError("bw serve request %s failed: %s" % (path, error))
+
+    if response.status != 200:
+        raise RuntimeError(
+            "bw serve request %s failed: %s" % (path, body.decode() or response.reason)
+        )
+
+    return body
+
+
+def server_list(objects: str, **query: str) -> list[dict[str, Any]]:
+    """
+    Function to return a list of vault objects from `bw serve`
+    """
+    data: list[dict[str, Any]] = json_loads(
+        server_request("/list/object/" + objects, **query)
+    )["data"]["data"]
+
+    return data
+
+
+def get_folders(session: str, foldername: str) -> str:
+    """
+    Function to return the ID  of the folder that matches the provided name
+    """
+    logging.debug("Folder name: %s", foldername)
+
+    if BW_SERVER:
+        folders = server_list("folders", search=foldername)
+    else:
+        proc_folders = subprocess.run(
+            bw_command("list", "folders", "--search", foldername, session=session),
+            stdout=subprocess.PIPE,
+            check=True,
+            close_fds=CLOSE_FDS,
+        )
+        folders = json_loads(proc_folders.stdout)
 
     try:
         return str([k["id"] for k in folders if k["name"] == foldername][0])
@@ -70,75 +304,178 @@ def get_folders(session: str, foldername: str) -> str:
     raise RuntimeError('"%s" folder not found' % foldername)
 
 
-def folder_items(session: str, folder_id: str) -> list[dict[str, Any]]:
+def folder_items(session: str, folder_id: str) -> Iterator[dict[str, Any]]:
     """
     Function to return items from a folder
+
+    If ijson is installed, items are yielded while `bw` is still writing the
+    list, instead of after the whole list has been read and parsed.
     """
     logging.debug("Folder ID: %s", folder_id)
 
-    proc_items = subprocess.run(
-        ["bw", "list", "items", "--folderid", folder_id, "--session", session],
-        stdout=subprocess.PIPE,
-        universal_newlines=True,
-        check=True,
-        encoding="utf-8",
-    )
+    if BW_SERVER:
+        yield from server_list("items", folderid=folder_id)
+        return
 
-    data: list[dict[str, Any]] = json.loads(proc_items.stdout)
+    command = bw_command("list", "items", "--folderid", folder_id, session=session)
 
-    return data
+    if not HAVE_IJSON:
+        proc_items = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            check=True,
+            close_fds=CLOSE_FDS,
+        )
+        yield from json_loads(proc_items.stdout)
+        return
+
+    # A failing `bw` leaves its output incomplete, so a parse error is only
+    # reported once it is known that `bw` itself succeeded
+    parse_error: Exception | None = None
+    with subprocess.Popen(
+        command, stdout=subprocess.PIPE, close_fds=CLOSE_FDS
+    ) as proc_stream:
+        try:
+            yield from ijson.items(proc_stream.stdout, "item")
+        except ijson.JSONError as error:
+            parse_error = error
+
+    if proc_stream.returncode:
+        raise subprocess.CalledProcessError(proc_stream.returncode, command)
+    if parse_error:
+        raise RuntimeError("Could not parse the item list: %s" % parse_error)
 
 
 def add_ssh_keys(
     session: str,
-    items: list[dict[str, Any]],
+    items: Iterable[dict[str, Any]],
     keyname: str,
     pwkeyname: str,
+    fpkeyname: str = "",
+    jobs: int = 1,
 ) -> None:
     """
     Function to attempt to get keys from a vault item
     """
-    for item in items:
-        logging.info("----------------------------------")
-        logging.info('Processing item "%s"', item["name"])
-        try:
-            ssh_key = fetch_key(session, item, keyname)
-        except RuntimeError as error:
-            logging.error(str(error))
-            continue
+    # Fingerprints of the keys in the agent, listed once an item has one
+    loaded: set[str] | None = None
+
+    # Fetching attachments is bound by `bw` start-up and network latency, so
+    # run up to `jobs` fetches at once. Everything else, logging included,
+    # happens one item at a time, in the order of `items`.
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        tasks: list[
+            tuple[dict[str, Any], dict[str, str], bool, Future[bytes] | None]
+        ] = []
+        for item in items:
+            fields = item_fields(item)
+            fingerprint = fields.get(fpkeyname) if fpkeyname else None
+            loaded_key = False
+            if fingerprint:
+                if loaded is None:
+                    loaded = loaded_fingerprints()
+                loaded_key = fingerprint in loaded
+            attachment = None
+            if not loaded_key and "fields" in item and "attachments" in item:
+                attachment = executor.submit(
+                    fetch_from_attachment, session, item, fields, keyname
+                )
+            tasks.append((item, fields, loaded_key, attachment))
 
-        private_key_pw = ""
+        for item, fields, loaded_key, attachment in tasks:
+            logging.info("----------------------------------")
+            logging.info('Processing item "%s"', item["name"])
+            if loaded_key:
+                logging.info("Key is already in the SSH agent - skipping")
+                continue
 
-        if "fields" in item:
             try:
-                private_key_pw = [
-                    k["value"] for k in item["fields"] if k["name"] == pwkeyname
-                ][0]
-                logging.debug("Passphrase declared")
-            except IndexError:
-                logging.warning(
-                    'No "%s" field found for item %s', pwkeyname, item["name"]
-                )
+                ssh_key = fetch_key(item, fields, keyname, attachment)
+            except RuntimeError as error:
+                logging.error(str(error))
+                continue
+
+            private_key_pw = ""
+
+            if "fields" in item:
+                if pwkeyname in fields:
+                    private_key_pw = fields[pwkeyname]
+                    logging.debug("Passphrase declared")
+                else:
+                    logging.warning(
+                        'No "%s" field found for item %s', pwkeyname, item["name"]
+                    )
 
-        try:
-            ssh_add(ssh_key, private_key_pw)
-        except subprocess.SubprocessError:
-            logging.warning('Could not add key "%s" to the SSH agent', item["name"])
+            try:
+                ssh_add(ssh_key, private_key_pw)
+            except subprocess.SubprocessError:
+                logging.warning('Could not add key "%s" to the SSH agent', item["name"])
 
 
-def fetch_key(session: str, item: dict[str, Any], keyname: str) -> str:
-    if "fields" in item and "attachments" in item:
+def loaded_fingerprints() -> set[str]:
+    """
+    Function to return the SHA256 fingerprints of the keys in the agent
+    """
+    proc_list = subprocess.run(
+        [SSH_ADD, "-l", "-E", "sha256"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=False,
+        close_fds=CLOSE_FDS,
+    )
+
+    # Exits with 1 if the agent has no keys, and prints a message instead
+    if proc_list.returncode:
+        return set()
+
+    return {line.split()[1] for line in proc_list.stdout.splitlines()}
+
+
+def item_fields(item: dict[str, Any]) -> dict[str, str]:
+    """
+    Function to return the custom fields of a vault item, by name
+    """
+    # Reversed, so the first of several fields with the same name wins
+    return {
+        field["name"]: field["value"] for field in reversed(item.get("fields") or [])
+    }
+
+
+def fetch_key(
+    item: dict[str, Any],
+    fields: dict[str, str],
+    keyname: str,
+    attachment: Future[bytes] | None,
+) -> bytes:
+    """
+    Function to return the key of a vault item, from the result of
+    fetch_from_attachment if it was started, or else from the item's notes
+    """
+    if attachment is not None:
         logging.debug(
             "Item %s has custom fields and attachments - searching for %s",
             item["name"],
             keyname,
         )
-        try:
-            return fetch_from_attachment(session, item, keyname)
-        except RuntimeWarning as warning:
-            logging.warning(str(warning))
-        except RuntimeError as error:
-            logging.error(str(error))
+        private_key_file, private_key_id = find_attachment(item, fields, keyname)
+        if private_key_file is None:
+            logging.warning('No "%s" field found for item %s', keyname, item["name"])
+        else:
+            logging.debug("Private key file declared")
+            if private_key_id is None:
+                logging.warning(
+                    'No attachment called "%s" found for item %s',
+                    private_key_file,
+                    item["name"],
+                )
+            else:
+                logging.debug("Private key ID found")
+                logging.debug("Item ID: %s", item["id"])
+                logging.debug("Key ID: %s", private_key_id)
+                try:
+                    return attachment.result()
+                except RuntimeError as error:
+                    logging.error(str(error))
 
     logging.debug("Couldn't find an ssh key in attachments - falling back to notes")
 
@@ -146,101 +483,105 @@ def fetch_key(session: str, item: dict[str, Any], keyname: str) -> str:
     # maybe check if the key starts with '----'?
     # or just pass it to ssh-agent, and let it fail?
     if isinstance(item["notes"], str):
-        return item["notes"]
+        return item["notes"].encode("utf-8")
 
     raise RuntimeError("Could not find an SSH key on item %s" % item["name"])
 
 
-def fetch_from_attachment(session: str, item: dict[str, Any], keyname: str) -> str:
+def find_attachment(
+    item: dict[str, Any], fields: dict[str, str], keyname: str
+) -> tuple[str | None, str | None]:
     """
-    Function to get the key contents from the Bitwarden vault
+    Function to return the file name and ID of the attachment holding the key
     """
-    private_key_file = ""
-    try:
-        private_key_file = [k["value"] for k in item["fields"] if k["name"] == keyname][
-            0
-        ]
-    except IndexError:
-        raise RuntimeWarning(
-            'No "%s" field found for item %s' % (keyname, item["name"])
-        )
+    private_key_file = fields.get(keyname)
+    if private_key_file is None:
+        return None, None
 
-    logging.debug("Private key file declared")
+    attachments = {
+        attachment["fileName"]: attachment["id"]
+        for attachment in reversed(item["attachments"])
+    }
+    return private_key_file, attachments.get(private_key_file)
 
-    try:
-        private_key_id = [
-            k["id"] for k in item["attachments"] if k["fileName"] == private_key_file
-        ][0]
-    except IndexError:
-        raise RuntimeWarning(
-            'No attachment called "%s" found for item %s'
-            % (private_key_file, item["name"])
-        )
 
-    logging.debug("Private key ID found")
-    logging.debug("Item ID: %s", item["id"])
-    logging.debug("Key ID: %s", private_key_id)
+def fetch_from_attachment(
+    session: str, item: dict[str, Any], fields: dict[str, str], keyname: str
+) -> bytes:
+    """
+    Function to get the key contents from the Bitwarden vault
+
+    This runs on the thread pool of add_ssh_keys, so it doesn't log anything:
+    problems are raised, and reported when the item is processed.
+    """
+    private_key_file, private_key_id = find_attachment(item, fields, keyname)
+    if private_key_file is None or private_key_id is None:
+        # reported by fetch_key, which falls back to the notes
+        raise RuntimeWarning("No attachment to fetch")
+
+    if BW_SERVER:
+        return server_request("/object/attachment/" + private_key_id, itemid=item["id"])
 
     try:
         proc_attachment = subprocess.run(
-            [
-                "bw",
+            bw_command(
                 "get",
                 "attachment",
                 private_key_id,
                 "--itemid",
                 item["id"],
                 "--raw",
-                "--session",
-                session,
-            ],
+                session=session,
+            ),
             stdout=subprocess.PIPE,
-            universal_newlines=True,
             check=True,
+            close_fds=CLOSE_FDS,
         )
     except subprocess.CalledProcessError:
-        raise RuntimeError("Could not get attachment from Bitwarden")
+        raise RuntimeError(
+            'Could not get attachment "%s" of item %s from Bitwarden'
+            % (private_key_file, item["name"])
+        )
 
     return proc_attachment.stdout
 
 
-def ssh_add(ssh_key: str, key_pw: str = "") -> None:
+def ssh_add(ssh_key: bytes, key_pw: str = "") -> None:
     """
     Adds the key to the agent
     """
     if key_pw:
-        envdict = dict(
-            os.environ,
-            SSH_ASKPASS=os.path.realpath(__file__),
-            SSH_KEY_PASSPHRASE=key_pw,
-        )
+        envdict = dict(SSH_ADD_ASKPASS_ENV, SSH_KEY_PASSPHRASE=key_pw)
     else:
-        envdict = dict(os.environ, SSH_ASKPASS_REQUIRE="never")
+        envdict = SSH_ADD_ENV
 
     logging.debug("Running ssh-add")
 
     # if the key doesn't end with a line break, let's add it
-    if not ssh_key.endswith("\n"):
+    if not ssh_key.endswith(b"\n"):
         logging.debug("Adding a line break at the end of the key")
-        ssh_key += "\n"
+        ssh_key += b"\n"
 
     # CAVEAT: `ssh-add` provides no useful output, even with maximum verbosity
     subprocess.run(
-        ["ssh-add", "-"],
-        input=ssh_key.encode("utf-8"),
+        [SSH_ADD, "-"],
+        input=ssh_key,
         # Works even if ssh-askpass is not installed
         env=envdict,
         universal_newlines=False,
         check=True,
+        close_fds=CLOSE_FDS,
     )
 
 
 if __name__ == "__main__":
 
-    def parse_args() -> argparse.Namespace:
+    def parse_args() -> "argparse.Namespace":
         """
         Function to parse command line arguments
         """
+        import argparse
+
         parser = argparse.ArgumentParser()
         parser.add_argument(
             "-d",
@@ -266,12 +607,36 @@ if __name__ == "__main__":
             default="passphrase",
             help="custom field name where key passphrase is stored",
         )
+        parser.add_argument(
+            "-F",
+            "--fingerprintfield",
+            default="fingerprint",
+            help="custom field name where key SHA256 fingerprint is stored",
+        )
         parser.add_argument(
             "-s",
             "--session",
             default="",
             help="session key of bitwarden",
         )
+        parser.add_argument(
+            "-k",
+            "--keyring",
+            action="store_true",
+            help="store the bitwarden session in the system keyring, and re-use it",
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="maximum number of keys to fetch from bitwarden in parallel",
+        )
+        parser.add_argument(
+            "--serve",
+            action="store_true",
+            help="query the vault through a temporary `bw serve` instance",
+        )
 
         return parser.parse_args()
 
@@ -291,9 +656,13 @@ if __name__ == "__main__":
 
         try:
             logging.info("Getting Bitwarden session")
-            session = get_session(args.session)
+            session = get_session(args.session, args.keyring)
             logging.debug("Session = %s", session)
 
+            if args.serve:
+                logging.info("Starting Bitwarden server")
+                start_server(session)
+
             logging.info("Getting folder list")
             folder_id = get_folders(session, args.foldername)
 
@@ -301,7 +670,14 @@ if __name__ == "__main__":
             items = folder_items(session, folder_id)
 
             logging.info("Attempting to add keys to ssh-agent")
-            add_ssh_keys(session, items, args.customfield, args.passphrasefield)
+            add_ssh_keys(
+                session,
+                items,
+                args.customfield,
+                args.passphrasefield,
+                args.fingerprintfield,
+                args.jobs,
+            )
         except RuntimeError as error:
             logging.critical(str(error))
         except subprocess.CalledProcessError as error:
@@ -309,9 +685,4 @@ if __name__ == "__main__":
                 logging.critical('"%s" error: %s', error.cmd[0], error.stderr)
             logging.debug("Error running %s", error.cmd)
 
-    if os.environ.get("SSH_ASKPASS") and os.environ.get(
-        "SSH_ASKPASS"
-    ) == os.path.realpath(__file__):
-        print(os.environ.get("SSH_KEY_PASSPHRASE"))
-    else:
-        main()
+    main()